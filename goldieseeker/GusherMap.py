@@ -1,11 +1,9 @@
 import pathlib
 import networkx as nx
+from functools import lru_cache
 from ast import literal_eval
 from numpy import genfromtxt, minimum
 from scipy.spatial.distance import cdist
-import matplotlib.pyplot as plt
-from matplotlib.colors import LinearSegmentedColormap
-from statistics import mean
 import warnings
 
 # Special characters for parsing files
@@ -41,8 +39,44 @@ LOW_CDICT =  {'red':   [[0.0, 0.0, 0.0],
                         [0.6, 0.4, 0.4],
                         [1.0, 0.7, 0.7]]}
 
-high_cmap = LinearSegmentedColormap('HighPath', segmentdata=HIGH_CDICT, N=256)
-low_cmap = LinearSegmentedColormap('LowPath', segmentdata=LOW_CDICT, N=256)
+
+# Map files are only parsed once per file, then shared between every GusherMap that uses them
+# Callers must not modify the cached results
+@lru_cache(maxsize=None)
+def read_gushers(filename):
+    """Return the names and coordinates of the gushers in a gushers file."""
+    return genfromtxt(filename, delimiter=',', names=['name', 'coord'], dtype=['U8', '2u4'])
+
+
+@lru_cache(maxsize=None)
+def read_distance_modifiers(filename):
+    """Return the norm and the distance modifiers matrix from a distance modifiers file.
+    If the matrix couldn't be read, return None and the error message instead of the matrix."""
+    # Read norm from the 2nd line of the file
+    with open(filename) as f:
+        f.readline()
+        norm_raw = f.readline().split(': ')[-1].strip(' \n')
+    try:
+        return float(norm_raw), genfromtxt(filename, delimiter=',', comments=COMMENT_CHAR), None
+    except ValueError as e:
+        return float(norm_raw), None, str(e)
+
+
+@lru_cache(maxsize=None)
+def read_connections(filename):
+    """Return the map name and the connections graph from a connections file."""
+    # Read the map name from the first line of the file
+    with open(filename) as f:
+        name = f.readline().strip(COMMENT_CHAR + ' \n')
+    return name, nx.read_adjlist(filename, comments=COMMENT_CHAR)
+
+
+@lru_cache(maxsize=None)
+def read_weights(filename):
+    """Return the weight dictionary string from a weights file."""
+    # Read the weight dictionary from the first non-commented line of the file
+    with open(filename) as f:
+        return next(line for line in f if not line.lstrip().startswith(COMMENT_CHAR)).strip()
 
 
 # noinspection PyTypeChecker,PyTypeChecker
@@ -56,33 +90,28 @@ class GusherMap:
         self._validate_distances()
         self._load_connections(str(self._path/'connections.txt'))
         if not weights:
-            # Read the weight dictionary from the first non-commented line of the file
-            # https://stackoverflow.com/a/26284995
-            f = (line for line in open(str(self._path/'weights.txt'))
-                 if not line.lstrip().startswith(COMMENT_CHAR))
-            weights = next(f).strip()
+            weights = read_weights(str(self._path/'weights.txt'))
         self._load_weights(literal_eval(weights))
 
     def _load_gushers(self, filename):
-        self._gushers = genfromtxt(filename, delimiter=',', names=['name', 'coord'], dtype=['U8', '2u4'])
+        self._gushers = read_gushers(filename)
 
     # TODO - use tkg's exact distances
     def _load_distances(self, filename, squad=False):
         coords = self._gushers['coord']
-        # Read norm from the 2nd line of the file
-        with open(filename) as f:
-            f.readline()
-            norm_raw = f.readline().split(': ')[-1].strip(' \n')
-        norm = float(norm_raw)
+        norm, distance_modifiers, error = read_distance_modifiers(filename)
         adjacency_matrix = cdist(coords, coords, 'minkowski', p=norm) / DISTANCE_SCALE_FACTOR
         try:
-            distance_modifiers = genfromtxt(filename, delimiter=',', comments=COMMENT_CHAR)
+            if error:
+                raise ValueError(error)
             adjacency_matrix += distance_modifiers
             if squad:
                 # Assume that it never takes longer to reach a gusher than it would have taken coming from basket/spawn
                 adjacency_matrix = minimum(adjacency_matrix, adjacency_matrix[0, :])
         except ValueError as e:
             warnings.warn(f"Couldn't read distance modifiers from '{filename}'\n" + str(e))
+        # Dense copy of the distances, indexed by gusher id (i.e. row in gushers.csv), for fast lookups
+        self.distance_matrix = adjacency_matrix.tolist()
         self.distances = nx.from_numpy_array(adjacency_matrix, create_using=nx.DiGraph)
         # noinspection PyTypeChecker
         nx.relabel_nodes(self.distances, lambda i: self._gushers['name'][i], False)
@@ -107,10 +136,7 @@ class GusherMap:
                                   for t in violations))
 
     def _load_connections(self, filename):
-        # Read the map name from the first line of the file
-        with open(filename) as f:
-            self.name = f.readline().strip(COMMENT_CHAR + ' \n')
-        connections_raw = nx.read_adjlist(filename, comments=COMMENT_CHAR)
+        self.name, connections_raw = read_connections(filename)
         conn_size = len(connections_raw)
         dist_size = len(self.distances)
         assert dist_size == conn_size + 1, f"Couldn't read {filename}\n" + \
@@ -120,6 +146,15 @@ class GusherMap:
         # There's probably some way to induce a subgraph of 'distances' by reading edges directly from connections.txt,
         #   but I'm too lazy to figure out what that is
 
+        # Number each gusher by its row in the distances matrix (the basket is always 0),
+        #   so that sets of gushers can be represented by bitmasks over those numbers
+        self.names = tuple(str(name) for name in self._gushers['name'])
+        self.name_to_id = {name: i for i, name in enumerate(self.names)}
+        # Bit j of adj_masks[i] is set iff gusher j is adjacent to gusher i
+        self.adj_masks = tuple(sum(1 << self.name_to_id[v] for v in self.connections.adj[name])
+                               if name in self.connections else 0
+                               for name in self.names)
+
     def _load_weights(self, weights_dict):
         self.weights = {BASKET_LABEL: 0}
         for gusher in self.connections:
@@ -170,6 +205,10 @@ class GusherMap:
         return self.connections.degree[vertex]
 
     def plot(self, strategy=None, tuning=0.5):
+        # matplotlib is slow to import and only needed for plotting, so it isn't imported until a map is plotted
+        import matplotlib.pyplot as plt
+        from matplotlib.colors import LinearSegmentedColormap
+
         background = plt.imread(str(self._path.parent.parent.resolve()/f'images/{self.map_id}.png'))
         pos = {gusher['name']: tuple(gusher['coord']) for gusher in self._gushers if gusher['name'] != BASKET_LABEL}
         pos_attrs = {node: (coord[0] - 40, coord[1]) for (node, coord) in pos.items()}
@@ -193,8 +232,9 @@ class GusherMap:
 
         if strategy:
             latencies, risks = strategy.get_costs(self)
-            key = f"average time: {mean(latencies.values()):0.2f}, worst time: {max(latencies.values()):0.2f}\n" \
-                  f"average risk: {mean(risks.values()):0.2f}, worst risk: {max(risks.values()):0.2f}"
+            key = f"average time: {sum(latencies.values())/len(latencies):0.2f}, " \
+                  f"worst time: {max(latencies.values()):0.2f}\n" \
+                  f"average risk: {sum(risks.values())/len(risks):0.2f}, worst risk: {max(risks.values()):0.2f}"
             if tuning is not None:
                 key = f"setting: {100*(1 - tuning):g}% speed, {100*tuning:g}% safety\n" + key
             # https://stackoverflow.com/a/32745842
@@ -221,6 +261,8 @@ class GusherMap:
             high_colors = [strat_graph[s][t]['depth'] for s, t in high_edges]
             low_edges = [(s, t) for s, t in strat_graph.edges if not strat_graph[s][t]['high']]
             low_colors = [strat_graph[s][t]['depth'] for s, t in low_edges]
+            high_cmap = LinearSegmentedColormap('HighPath', segmentdata=HIGH_CDICT, N=256)
+            low_cmap = LinearSegmentedColormap('LowPath', segmentdata=LOW_CDICT, N=256)
             color_kwargs = ({'edgelist':  high_edges, 'edge_color': high_colors, 'edge_cmap': high_cmap},
                             {'edgelist': low_edges, 'edge_color': low_colors, 'edge_cmap': low_cmap})
             for kwargs in color_kwargs:
@@ -1,8 +1,7 @@
 from .GusherMap import BASKET_LABEL
-from copy import deepcopy
-from statistics import mean
-from statistics import pstdev
-from pyparsing import Regex, Forward, Suppress, Optional, Group
+import re
+from collections import deque
+from math import sqrt
 
 # Flag to indicate gusher is non-findable
 NEVER_FIND_FLAG = '*'
@@ -10,8 +9,13 @@ NEVER_FIND_FLAG = '*'
 
 # TODO - switch to using anytree
 class GusherNode:
+    # Nodes are created in bulk when building and copying trees, so store attributes in slots instead of a __dict__
+    __slots__ = ('name', 'id', 'low', 'high', 'parent', 'findable', 'size', 'distance', 'latency', 'total_latency',
+                 'weight', 'risk', 'total_risk', '_tree_str')
+
     def __init__(self, name, gusher_map=None, findable=True):
         self.name = name
+        self.id = gusher_map.name_to_id[name] if gusher_map else None  # row of this gusher in map's distance matrix
         self.low = None  # next gusher to open if this gusher is low
         self.high = None  # next gusher to open if this gusher is high
         self.parent = None  # gusher previously opened in sequence
@@ -32,6 +36,7 @@ class GusherNode:
         # This does not mean the gusher actually spawns more fish; it is just a way of telling the algorithm that
         #   some gushers spawn more dangerous trash than others (e.g. gushers next to basket)
         self.total_risk = 0  # sum of risks of this node's findable descendants
+        self._tree_str = None  # cached result of write_tree(); cleared whenever the subtree changes shape
 
     def __str__(self):
         return self.name + (NEVER_FIND_FLAG if not self.findable else "")
@@ -49,30 +54,76 @@ class GusherNode:
         # return write_tree(self)  + f'; time: {self.total_latency}, risk: {self.total_risk}}}'
 
     def __iter__(self):
-        yield self
-        if self.high:
-            yield from self.high.__iter__()
-        if self.low:
-            yield from self.low.__iter__()
+        # Preorder traversal (node, then high subtree, then low subtree) using an explicit stack
+        stack = deque([self])
+        pop, append = stack.pop, stack.append
+        while stack:
+            node = pop()
+            yield node
+            if node.low:
+                append(node.low)
+            if node.high:
+                append(node.high)
 
+    # Nodes are identified by the gusher they open and whether that gusher is findable
+    # Gushers are compared by name, so nodes created without a map or with different maps compare consistently
+    # Use is_same_tree() to compare entire trees
     def __eq__(self, other):
-        return isinstance(other, GusherNode) and write_tree(self) == write_tree(other)
-
-    # Override deepcopy so that it does not copy non-root nodes' cost attributes (weight, size, latency, etc.)
-    # This improves performance without sacrificing any accuracy
+        if not isinstance(other, GusherNode):
+            return NotImplemented
+        return self.name == other.name and self.findable == other.findable
+
+    def __hash__(self):
+        return hash((self.name, self.findable))
+
+    def is_same_tree(self, other):
+        """Check whether the trees rooted at this node and another node represent the same strategy."""
+        if not isinstance(other, GusherNode):
+            return False
+        # Compare corresponding pairs of nodes, stopping at the first mismatch
+        stack = deque([(self, other)])
+        pop, append = stack.pop, stack.append
+        while stack:
+            node, other_node = pop()
+            if node.name != other_node.name or node.findable != other_node.findable:
+                return False
+            for child, other_child in ((node.low, other_node.low), (node.high, other_node.high)):
+                if child and other_child:
+                    append((child, other_child))
+                elif child or other_child:
+                    return False
+        return True
+
+    # Override deepcopy so that it uses clone() instead of going through copy.deepcopy's memo and object protocol
+    # Every attribute of a GusherNode is either immutable or a reference to another node in the tree,
+    #   so the tree can be copied safely by copying each node's slots and rewiring the references
     # noinspection PyDefaultArgument
     def __deepcopy__(self, memodict={}):
-        tree_copy = GusherNode(self.name, findable=self.findable)
-        if not self.parent:
-            cost_attrs = ('size', 'distance', 'latency', 'total_latency', 'weight', 'risk', 'total_risk')
-            tree_copy.__dict__.update({attr: self.__dict__.get(attr) for attr in cost_attrs})
-        if self.high:
-            tree_copy.high = deepcopy(self.high)
-            tree_copy.high.parent = tree_copy
-        if self.low:
-            tree_copy.low = deepcopy(self.low)
-            tree_copy.low.parent = tree_copy
-        return tree_copy
+        return self.clone()
+
+    def clone(self):
+        """Return a copy of the subtree rooted at this node. The copy of this node has no parent."""
+        slots = GusherNode.__slots__
+
+        def copy_node(node, parent):
+            new = GusherNode.__new__(GusherNode)
+            for slot in slots:
+                setattr(new, slot, getattr(node, slot))
+            new.parent = parent
+            return new
+
+        root = copy_node(self, None)
+        stack = deque([(self, root)])
+        pop, append = stack.pop, stack.append
+        while stack:
+            node, new = pop()
+            if node.high:
+                new.high = copy_node(node.high, new)
+                append((node.high, new.high))
+            if node.low:
+                new.low = copy_node(node.low, new)
+                append((node.low, new.low))
+        return root
 
     def add_children(self, high, low, dist_h=1, dist_l=1):
         size_h, size_l = 0, 0
@@ -96,6 +147,11 @@ class GusherNode:
             size_l = self.low.size
             totlat_l = self.low.total_latency
             totrisk_l = self.low.total_risk
+        # Adding children changes the shape of every subtree containing this node
+        ancestor = self
+        while ancestor:
+            ancestor._tree_str = None
+            ancestor = ancestor.parent
         self.size = size_l + size_h + (1 if self.findable else 0)
         self.total_latency = totlat_l + dist_l*size_l + totlat_h + dist_h*size_h
         self.total_risk = totrisk_l + totrisk_h + self.weight*self.total_latency
@@ -106,90 +162,154 @@ class GusherNode:
     def nonfindable_nodes(self):
         return (node for node in self if not node.findable)
 
-    def update_costs(self, gusher_map=None, start=BASKET_LABEL):
-        """Update distances, latencies and risks of this node's descendants. Should be called on root of tree."""
-        def recurse(node, parent_latency, total_predecessor_weight):
-            if node.parent:
-                if gusher_map:
-                    node.distance = gusher_map.distance(node.parent.name, node.name)
-                node.latency = parent_latency + node.distance
-                node.risk = node.parent.risk + total_predecessor_weight*node.distance
+    def flatten(self):
+        """Flatten the subtree rooted at this node into a dict of parallel lists, in preorder.
+        This node is always first, and each node is followed by its smaller subtree and then its larger subtree
+        (the high subtree goes first if they are the same size), so the larger subtree is stored contiguously last.
+            'nodes': the nodes themselves
+            'parents': index of each node's parent in the lists (-1 for this node)
+            'distances', 'weights', 'findable': each node's distance, weight and findability"""
+        nodes, parents = [], []
+        stack = deque([(self, -1)])
+        pop, append = stack.pop, stack.append
+        while stack:
+            node, parent = pop()
+            index = len(nodes)
+            nodes.append(node)
+            parents.append(parent)
+            # Push the larger subtree first so that it is stored after the smaller one
+            high, low = node.high, node.low
+            if high and low and high.size > low.size:
+                append((high, index))
+                append((low, index))
             else:
-                # Latency of root node is distance between start (i.e. basket) and root node
-                if gusher_map:
-                    node.latency = gusher_map.distance(start, node.name)
-                    node.total_latency += node.latency*node.size
-                else:
-                    node.latency = 0
-                node.risk = 0
-
-            if node.high:
-                recurse(node.high, node.latency, total_predecessor_weight + node.weight)
-            if node.low:
-                recurse(node.low, node.latency, total_predecessor_weight + node.weight)
+                if low:
+                    append((low, index))
+                if high:
+                    append((high, index))
+        return {'nodes': nodes,
+                'parents': parents,
+                'distances': [node.distance for node in nodes],
+                'weights': [node.weight for node in nodes],
+                'findable': [node.findable for node in nodes]}
 
-        recurse(self, 0, 0)
+    def update_costs(self, gusher_map=None, start=BASKET_LABEL):
+        """Update distances, latencies and risks of this node's descendants. Should be called on root of tree.
+        Return the flattened tree (see flatten()), with the updated costs in 'latencies' and 'risks'."""
+        tree = self.flatten()
+        nodes, parents, distances, weights = tree['nodes'], tree['parents'], tree['distances'], tree['weights']
+        if gusher_map:
+            # Look up ids by name, since the nodes may have been created without a map or with a different map
+            distance_matrix, name_to_id = gusher_map.distance_matrix, gusher_map.name_to_id
+            ids = [name_to_id[node.name] for node in nodes]
+            root_distance = distance_matrix[name_to_id[self.parent.name]][ids[0]] if self.parent else self.distance
+            distances = [root_distance] + [distance_matrix[ids[parents[i]]][ids[i]] for i in range(1, len(nodes))]
+
+        # Costs of this node
+        latencies, risks = [0]*len(nodes), [0]*len(nodes)
+        predecessor_weights = [weights[0]]*len(nodes)  # total weight of each node and the nodes opened before it
+        if self.parent:
+            latencies[0] = distances[0]
+            risks[0] = self.parent.risk
+        elif gusher_map:
+            # Latency of root node is distance between start (i.e. basket) and root node
+            latencies[0] = distance_matrix[name_to_id[start]][ids[0]]
+            self.total_latency += latencies[0]*self.size
+
+        # Every node's parent comes before it, so a single forward pass computes everyone's costs
+        for i in range(1, len(nodes)):
+            parent = parents[i]
+            latencies[i] = latencies[parent] + distances[i]
+            risks[i] = risks[parent] + predecessor_weights[parent]*distances[i]
+            predecessor_weights[i] = predecessor_weights[parent] + weights[i]
+
+        for node, distance, latency, risk in zip(nodes, distances, latencies, risks):
+            node.distance, node.latency, node.risk = distance, latency, risk
+        tree.update(distances=distances, latencies=latencies, risks=risks)
+        return tree
 
     def calc_tree_score(self, gusher_map=None, start=BASKET_LABEL):
         """Calculate and store the total latency and total risk of the tree rooted at this node."""
-        self.update_costs(gusher_map, start)
+        tree = self.update_costs(gusher_map, start)
         self.total_latency, self.total_risk = 0, 0
-        for node in self.findable_nodes():
-            self.total_latency += node.latency
-            self.total_risk += node.risk
+        for findable, latency, risk in zip(tree['findable'], tree['latencies'], tree['risks']):
+            if findable:
+                self.total_latency += latency
+                self.total_risk += risk
 
     def validate(self, gusher_map=None):
         """Check that tree is a valid strategy tree."""
-        def recurse(node, predecessors, possible_nodes):
+        if gusher_map:
+            unaccounted = set(gusher_map).difference(node.name for node in self.findable_nodes())
+            if unaccounted:
+                raise ValidationError(self, 'Strategy is not guaranteed to find Goldie if hiding in gushers ' +
+                                            ', '.join(unaccounted))
+
+        # Gushers are tracked by their ids if a map is given, otherwise by their names
+        # Ids are looked up by name, since the nodes may have been created without a map
+        if gusher_map:
+            name_to_id = gusher_map.name_to_id
+            neighborhoods = {name_to_id[v]: {name_to_id[u] for u in gusher_map.adj(v)} for v in gusher_map}
+
+            def gusher_names(gushers):
+                return {gusher_map.names[u] for u in gushers}
+        else:
+            neighborhoods = dict()
+
+            def gusher_names(gushers):
+                return gushers
+
+        # Preorder traversal using an explicit stack of (node, opened gushers, gushers that could have the Goldie)
+        stack = deque([(self, set(), set(neighborhoods))])
+        pop, append = stack.pop, stack.append
+        while stack:
+            node, predecessors, possible_nodes = pop()
+            gusher = name_to_id[node.name] if gusher_map else node.name
             # can't open the same gusher twice
-            if node.name in predecessors:
-                raise ValidationError(node, f'gusher {node} already in set of opened gushers: {predecessors}')
+            if gusher in predecessors:
+                raise ValidationError(node, f'gusher {node} already in set of opened gushers: '
+                                            f'{gusher_names(predecessors)}')
 
             if possible_nodes:
-                if node.name in possible_nodes:
-                    possible_nodes.remove(node.name)
+                if gusher in possible_nodes:
+                    possible_nodes.remove(gusher)
                     if not node.findable:
                         raise ValidationError(node, f'gusher {node} is incorrectly marked non-findable, '
                                                     f'should be {node.name}')
-                elif node.name not in possible_nodes and node.findable:
+                elif node.findable:
                     raise ValidationError(node, f'gusher {node} is incorrectly marked findable, '
                                                 f'should be {node.name + NEVER_FIND_FLAG}')
 
             if node.high or node.low:
                 if not possible_nodes:
                     raise ValidationError(node, f'Goldie should have been found after opening gusher {node}')
-                pred_new = predecessors.union({node.name})
-                if gusher_map:
-                    neighborhood = set(gusher_map.adj(node.name))
-                else:
-                    neighborhood = set()
+                pred_new = predecessors.union({gusher})
+                neighborhood = neighborhoods.get(gusher, set())
 
                 # make sure parent/child references are consistent
-                if node.high:
-                    assert node.high.parent is node, f'node = {node}, node.high = {node.high}, ' \
-                                                     f'node.high.parent = {node.high.parent}'
-                    recurse(node.high, pred_new, possible_nodes.intersection(neighborhood))
+                # push low child first so that the high subtree is checked first
                 if node.low:
                     assert node.low.parent is node, f'node = {node}, node.low = {node.low}, ' \
                                                     f'node.low.parent = {node.low.parent}'
-                    recurse(node.low, pred_new, possible_nodes.difference(neighborhood))
+                    append((node.low, pred_new, possible_nodes.difference(neighborhood)))
+                if node.high:
+                    assert node.high.parent is node, f'node = {node}, node.high = {node.high}, ' \
+                                                     f'node.high.parent = {node.high.parent}'
+                    append((node.high, pred_new, possible_nodes.intersection(neighborhood)))
             else:
                 # reaching a leaf node must guarantee that the Goldie will be found
                 if possible_nodes:
-                    raise ValidationError(node, f'Goldie could still be in gushers {possible_nodes} '
+                    raise ValidationError(node, f'Goldie could still be in gushers {gusher_names(possible_nodes)} '
                                                 f'after opening gusher {node}')
 
-        if gusher_map:
-            unaccounted = set(gusher_map).difference(node.name for node in self.findable_nodes())
-            if unaccounted:
-                raise ValidationError(self, 'Strategy is not guaranteed to find Goldie if hiding in gushers ' +
-                                            ', '.join(unaccounted))
-        recurse(self, set(), set(gusher_map) if gusher_map else set())
-
     def get_costs(self, gusher_map=None):
         self.update_costs(gusher_map)
-        latencies = {str(node): node.latency for node in self.findable_nodes()}
-        risks = {str(node): node.risk for node in self.findable_nodes()}
+        latencies, risks = dict(), dict()
+        for node in self:
+            if node.findable:
+                name = str(node)
+                latencies[name] = node.latency
+                risks[name] = node.risk
         return latencies, risks
 
     def report(self, gusher_map=None, quiet=0):
@@ -199,8 +319,10 @@ class GusherNode:
         latencies, risks = self.get_costs(gusher_map)
         cost_long = f"times: {{{', '.join(f'{node}: {time:0.2f}' for node, time in sorted(latencies.items()))}}}\n"\
                     f"risks: {{{', '.join(f'{node}: {risk:0.2f}' for node, risk in sorted(risks.items()))}}}\n"
-        cost_short = f"avg. time: {mean(latencies.values()):0.2f} +/- {pstdev(latencies.values()):0.2f}\n"\
-                     f"avg. risk: {mean(risks.values()):0.2f} +/- {pstdev(risks.values()):0.2f}"
+        mean_latency, stdev_latency = mean_and_stdev(latencies.values())
+        mean_risk, stdev_risk = mean_and_stdev(risks.values())
+        cost_short = f"avg. time: {mean_latency:0.2f} +/- {stdev_latency:0.2f}\n"\
+                     f"avg. risk: {mean_risk:0.2f} +/- {stdev_risk:0.2f}"
 
         output = short_str
         if quiet < 3:
@@ -237,28 +359,112 @@ class ValidationError(Exception):
         super().__init__(node, message)
 
 
+def mean_and_stdev(values):
+    """Return the mean and population standard deviation of some values, computed in a single pass using
+    Welford's algorithm."""
+    n, mean, sum_sq = 0, 0.0, 0.0  # sum_sq = sum of squared differences from the current mean
+    for x in values:
+        n += 1
+        delta = x - mean
+        mean += delta/n
+        sum_sq += delta*(x - mean)
+    if not n:
+        raise ValueError('mean_and_stdev requires at least one data point')
+    return mean, sqrt(sum_sq/n)
+
+
 def write_tree(root):
     """Write the strategy encoded by the subtree rooted at 'root' in modified Newick format.
     V(H, L) represents the tree with root node V, high subtree H, and low subtree L.
     A node name followed by * indicates that the gusher is being opened solely for information and the Goldie will
     never be found there."""
-    if root.high and root.low:
-        return f'{root}({write_tree(root.high)}, {write_tree(root.low)})'
-    elif root.high:
-        return f'{root}({write_tree(root.high)},)'
-    elif root.low:
-        return f'{root}(,{write_tree(root.low)})'
-    else:
-        return f'{root}'
+    def recurse(node, out):  # append the pieces of the subtree's string to out
+        if node._tree_str is not None:
+            out.append(node._tree_str)
+        elif node.high and node.low:
+            out.append(f'{node}(')
+            recurse(node.high, out)
+            out.append(', ')
+            recurse(node.low, out)
+            out.append(')')
+        elif node.high:
+            out.append(f'{node}(')
+            recurse(node.high, out)
+            out.append(',)')
+        elif node.low:
+            out.append(f'{node}(,')
+            recurse(node.low, out)
+            out.append(')')
+        else:
+            out.append(str(node))
+
+    if root._tree_str is None:
+        buf = []
+        recurse(root, buf)
+        root._tree_str = ''.join(buf)
+    return root._tree_str
 
 
 # Strategy tree grammar
-node = Regex(rf'\w+[{NEVER_FIND_FLAG}]?')
-LPAREN, COMMA, RPAREN = map(Suppress, '(,)')
-tree = Forward()
-subtree = Group(Optional(tree))
-subtrees = LPAREN - subtree.setResultsName('high') - COMMA - subtree.setResultsName('low') - RPAREN
-tree << node.setResultsName('root') - Optional(subtrees)
+#   tree := NAME ['(' [tree] ',' [tree] ')']
+# NAME is a gusher name, optionally followed by the never-find flag
+TOKEN = re.compile(rf'\s*(?:(?P<name>\w+{re.escape(NEVER_FIND_FLAG)}?)|(?P<punct>[(),]))')
+
+
+def tokenize(tree_str):
+    """Split a strategy string into a list of (token, position) pairs. A token is either a node name or one of '(,)'."""
+    tokens = []
+    pos = 0
+    while pos < len(tree_str):
+        match = TOKEN.match(tree_str, pos)
+        if not match:
+            if tree_str[pos:].isspace():
+                break
+            raise ValueError(f"Unexpected character {tree_str[pos]!r} at position {pos} of {tree_str!r}")
+        tokens.append((match.group('name') or match.group('punct'), match.start(match.lastindex)))
+        pos = match.end()
+    return tokens
+
+
+def parse_tree(tree_str):
+    """Parse a strategy string into nested (name, findable, high, low) tuples, where high and low are either parsed
+    subtrees or None."""
+    tokens = tokenize(tree_str)
+
+    def expected(what, i):
+        if i < len(tokens):
+            token, pos = tokens[i]
+            return ValueError(f"Expected {what} at position {pos} of {tree_str!r}, found {token!r}")
+        return ValueError(f"Expected {what} at end of {tree_str!r}")
+
+    def is_name(i):
+        return i < len(tokens) and tokens[i][0] not in '(,)'
+
+    def parse(i):  # parse the tree starting at tokens[i]; return the parsed tree and the index of the next token
+        if not is_name(i):
+            raise expected('gusher name', i)
+        name = tokens[i][0]
+        findable = not name.endswith(NEVER_FIND_FLAG)
+        high, low = None, None
+        i += 1
+        if i < len(tokens) and tokens[i][0] == '(':
+            i += 1
+            if is_name(i):
+                high, i = parse(i)
+            if i >= len(tokens) or tokens[i][0] != ',':
+                raise expected("','", i)
+            i += 1
+            if is_name(i):
+                low, i = parse(i)
+            if i >= len(tokens) or tokens[i][0] != ')':
+                raise expected("')'", i)
+            i += 1
+        return (name.rstrip(NEVER_FIND_FLAG), findable, high, low), i
+
+    parsed, end = parse(0)
+    if end < len(tokens):
+        raise expected('end of strategy', end)
+    return parsed
 
 
 def read_tree(tree_str, gusher_map, start=BASKET_LABEL):
@@ -267,25 +473,24 @@ def read_tree(tree_str, gusher_map, start=BASKET_LABEL):
     A node name followed by * indicates that the gusher is being opened solely for information and the Goldie will
     never be found there."""
 
-    def build_tree(tokens):  # recursively convert ParseResults object into GusherNode tree
-        findable = tokens.root[-1] is not NEVER_FIND_FLAG
-        rootname = tokens.root.rstrip(NEVER_FIND_FLAG)
+    def build_tree(parsed):  # recursively convert parsed tuples into GusherNode tree
+        rootname, findable, parsed_high, parsed_low = parsed
         try:
             root = GusherNode(rootname, gusher_map=gusher_map, findable=findable)
         except KeyError as err:
             raise ValueError(f"Couldn't find gusher {err}!") from None
         else:
-            if tokens.high or tokens.low:
+            if parsed_high or parsed_low:
                 high, low = None, None
                 dist_h, dist_l = 1, 1
-                if tokens.high:
-                    high = build_tree(tokens.high)
+                if parsed_high:
+                    high = build_tree(parsed_high)
                     try:
                         dist_h = gusher_map.distance(rootname, high.name)
                     except KeyError:
                         raise ValueError(f"No connection between {rootname} and {high.name}!") from None
-                if tokens.low:
-                    low = build_tree(tokens.low)
+                if parsed_low:
+                    low = build_tree(parsed_low)
                     try:
                         dist_l = gusher_map.distance(rootname, low.name)
                     except KeyError:
@@ -293,24 +498,26 @@ def read_tree(tree_str, gusher_map, start=BASKET_LABEL):
                 root.add_children(high=high, low=low, dist_h=dist_h, dist_l=dist_l)
             return root
 
-    tokens = tree.parseString(tree_str, parseAll=True)
-    root = build_tree(tokens)
+    root = build_tree(parse_tree(tree_str))
     root.calc_tree_score(gusher_map, start)
     return root
 
 
 def write_instructions(tree):
     """Convert strategy tree into human-readable instructions."""
-    def recurse(subtree, depth):
+    def recurse(subtree, depth, out):  # append the lines of the subtree's instructions to out
         indent = "   "*depth
-        result = ""
         if subtree.size > 2 or (subtree.high and subtree.low):
-            result += f"open {subtree}\n"
+            out.append(f"open {subtree}\n")
             if subtree.high:
-                result += indent + f"{subtree} high --> " + recurse(subtree.high, depth+1)
+                out.append(indent + f"{subtree} high --> ")
+                recurse(subtree.high, depth+1, out)
             if subtree.low:
-                result += indent + f"{subtree} low --> " + recurse(subtree.low, depth+1)
+                out.append(indent + f"{subtree} low --> ")
+                recurse(subtree.low, depth+1, out)
         else:
-            result = ', '.join(str(node) for node in subtree) + '\n'
-        return result
-    return recurse(tree, 0).strip('\n ')
+            out.append(', '.join(str(node) for node in subtree) + '\n')
+
+    buf = []
+    recurse(tree, 0, buf)
+    return ''.join(buf).strip('\n ')
@@ -1,6 +1,5 @@
 from .GusherMap import GusherMap, BASKET_LABEL
-from .GusherNode import GusherNode, NEVER_FIND_FLAG, write_tree
-from copy import deepcopy
+from .GusherNode import GusherNode, NEVER_FIND_FLAG
 
 
 def flag(findable):
@@ -10,6 +9,14 @@ def flag(findable):
         return NEVER_FIND_FLAG
 
 
+def bits(mask):
+    """Yield the positions of the set bits in a bitmask, from lowest to highest."""
+    while mask:
+        bit = mask & -mask
+        yield bit.bit_length() - 1
+        mask ^= bit
+
+
 def get_strat_greedy(gusher_map):
     """Build a decision tree for the gusher gushers. Greedy algorithm not guaranteed to find the optimal tree,
     but should still return something decent."""
@@ -41,95 +48,240 @@ def get_strat_greedy(gusher_map):
     return recurse(gusher_map.connections)
 
 
-def get_strat(gushers, start=BASKET_LABEL, tuning=0.5, all_distances=None, all_weights=None, debug=False):
-    """Build the optimal decision tree for a gusher map. Memoized algorithm."""
-    def print_log(*args, **kwargs):
-        if debug:
-            print(*args, **kwargs)
+def solve_strat(all_gushers, start, adj_masks, distances, weights, open_weights, tuning, log=None, names=None):
+    """Search for the optimal strategy using only integers, floats, tuples, and lists of them.
+    Gushers are referred to by their ids, which are also their bit positions in bitmasks of gushers.
+    all_gushers = bitmask of the gushers that might have the Goldie
+    start = id of the gusher (i.e. basket) that the search starts from
+    adj_masks[u] = bitmask of the gushers adjacent to gusher u
+    distances[u][v] = distance from gusher u to gusher v
+    weights[u] = risk weight of gusher u
+    open_weights[u] = risk weight used when gusher u is the most recently opened gusher
+    log = function that receives debug messages, or None; names[u] = name of gusher u, only needed for log
+
+    Return the best candidate for the whole map as a tuple (vertex, findable, size, total_latency, total_risk,
+    high, low), where high and low are the candidates chosen for the subgraphs it splits into (None if empty)."""
+    def key_str(key):
+        suspected, opened = key
+        return f'({", ".join(names[u] for u in bits(suspected))} | ' \
+               f'{", ".join(f"~{names[o]}" for o in bits(opened))})'
 
-    def distance(start, end):
-        return all_distances if all_distances else gushers.distance(start, end)
+    def tree_str(candidate):
+        """Write the subtree of a candidate in the same format as write_tree()."""
+        def recurse(c, out):  # append the pieces of the subtree's string to out
+            vertex, findable, size, total_latency, total_risk, high, low = c
+            out.append(f'{names[vertex]}{flag(findable)}')
+            if high and low:
+                out.append('(')
+                recurse(high, out)
+                out.append(', ')
+                recurse(low, out)
+                out.append(')')
+            elif high:
+                out.append('(')
+                recurse(high, out)
+                out.append(',)')
+            elif low:
+                out.append('(,')
+                recurse(low, out)
+                out.append(')')
 
-    def weight(vertex):
-        return all_weights if all_weights else gushers.weight(vertex)
+        buf = []
+        recurse(candidate, buf)
+        return ''.join(buf)
 
-    def score(latency, risk):
+    def final_score(candidate, latest_open):
+        """Return the score of a candidate, counting the trip to it from the most recently opened gusher."""
+        vertex, findable, size, total_latency, total_risk, high, low = candidate
+        latency = total_latency + distances[latest_open][vertex]*size
+        risk = total_risk + open_weights[latest_open]*latency
         return tuning*risk + (1-tuning)*latency
 
-    def candidate_cost(candidate, latest_open):
-        latency = candidate.total_latency + distance(latest_open, candidate.name)*candidate.size
-        risk = candidate.total_risk + weight(latest_open)*latency
-        return latency, risk
+    # Bounds on the final score of a candidate, used to prune candidates that choose() can never pick
+    # Apart from the root subgraph, the most recently opened gusher is always one of the gushers in all_gushers
+    # final score = tuning*total_risk + factor*total_latency + factor*distance*size, where factor depends on the
+    # most recently opened gusher and distance is the distance from it
+    gusher_ids = tuple(bits(all_gushers))
+    factors = {u: tuning*open_weights[u] + (1-tuning) for u in gusher_ids}
+    min_factor, max_factor = min(factors.values()), max(factors.values())
+    min_dist_factor = {v: min((factors[u]*distances[u][v] for u in gusher_ids if u != v), default=0)
+                       for v in gusher_ids}
+    max_dist_factor = {v: max((factors[u]*distances[u][v] for u in gusher_ids if u != v), default=0)
+                       for v in gusher_ids}
+
+    def score_bounds(candidate):
+        """Return the lowest and highest possible final scores of a candidate (see final_score())."""
+        vertex, findable, size, total_latency, total_risk, high, low = candidate
+        return (tuning*total_risk + min_factor*total_latency + min_dist_factor[vertex]*size,
+                tuning*total_risk + max_factor*total_latency + max_dist_factor[vertex]*size)
+
+    def prune(candidates):
+        """Remove the candidates whose lowest possible final score is higher than the highest possible final score
+        of the best candidate. choose() can never pick them, no matter which gusher was opened last."""
+        bounds = [score_bounds(candidate) for candidate in candidates]
+        best_upper_bound = min(upper for lower, upper in bounds)
+        return [candidate for candidate, (lower, upper) in zip(candidates, bounds) if lower <= best_upper_bound]
 
     solved_subgraphs = dict()
-    # dict that associates a subgraph with its solution subtrees and their objective scores
-    # stores deep copies of trees to avoid entangling references between different candidates
+    # dict that associates a subgraph with its candidate subtrees
+    # a subgraph is keyed by (suspected, opened), where
+    #   suspected = bitmask of unopened gushers that might have the Goldie
+    #   opened = bitmask of opened gushers
+    # candidates are never modified once created, so they can be shared between subgraphs without copying them
+
+    def subgraph_key(suspected, opened):
+        """Return the key for a subgraph, keeping only the opened gushers that affect which gushers can be opened next.
+        Opened gushers are never suspected, so an opened gusher that is adjacent to all/none of the suspected gushers
+        would be skipped by splits() even if it hadn't been opened. Subgraphs that only differ by such gushers have
+        the same candidates."""
+        relevant = 0
+        for vertex in bits(opened):
+            neighborhood = adj_masks[vertex]
+            if suspected & neighborhood and suspected & ~neighborhood:
+                relevant |= 1 << vertex
+        return suspected, relevant
 
-    def recurse(suspected, opened, solved):
-        """Return the optimal subtree to follow given a set of suspected gushers, a set of opened gushers,
-        and the most recently opened gusher."""
-        # First 3 arguments refer to gushers using strings, but recurse() returns a GusherNode
-        # suspected = set of unopened gushers that might have the Goldie
-        # opened = tuple of opened gushers in the order they were opened
+    def splits(key):
+        """Return the gushers worth opening for a subgraph, along with the subgraphs that result from opening them."""
+        suspected, opened = key
+        result = list()
+        for vertex in bits(all_gushers & ~opened):
+            bit = 1 << vertex
+            findable = bool(suspected & bit)
+            suspect_if_high = suspected & adj_masks[vertex]
+            suspect_if_low = suspected & ~adj_masks[vertex] & ~bit
+            # Don't open non-suspected gushers that are adjacent to all/none of the suspected gushers
+            # Opening them can neither find the Goldie nor provide additional information about the Goldie
+            if not findable and not (suspect_if_high and suspect_if_low):
+                continue
+            opened_new = opened | bit
+            result.append((vertex, findable,
+                           subgraph_key(suspect_if_high, opened_new), subgraph_key(suspect_if_low, opened_new)))
+        return result
 
+    def choose(key, latest_open):
+        """Return the best candidate for a subgraph, given the most recently opened gusher."""
+        suspected = key[0]
         # Base cases
-        n = len(suspected)
-        if n == 0:
+        if not suspected:
             return None
-        if n == 1:
-            return GusherNode(list(suspected)[0], gushers)
+        if not suspected & (suspected - 1):
+            return suspected.bit_length() - 1, True, 1, 0, 0, None, None
 
+        candidates = solved_subgraphs[key]
+        # Score all candidates in one pass, keeping the lowest score (first one wins ties)
+        best, best_score = None, None
+        for candidate in candidates:
+            score = final_score(candidate, latest_open)
+            if best is None or score < best_score:
+                best, best_score = candidate, score
+        if log:
+            log(f'{key_str(key)}; options: \n' +
+                '\n'.join(f'    ~{names[latest_open]}--{distances[latest_open][c[0]]:0.2f}--> ' +
+                          f'{names[c[0]]}{flag(c[1])}, ' +
+                          f'raw score: {tuning*c[4] + (1-tuning)*c[3]:0.2f}, ' +
+                          f'final score: {final_score(c, latest_open):0.2f}'
+                          for c in candidates) +
+                f'\n    choose gusher {names[best[0]]}{flag(best[1])}: {tree_str(best)}')
+        return best
+
+    def solve(key):
+        """Generate the candidate subtrees for a subgraph whose child subgraphs have all been solved."""
         candidates = list()
-        key = (frozenset(suspected), frozenset(opened))
-        key_str = f'({", ".join(str(u) for u in suspected)} | {", ".join(f"~{o}" for o in opened)})'
-        if key in solved:  # Don't recalculate subtrees for subgraphs we've already solved
-            candidates = deepcopy(solved[key])
+        for vertex, findable, high_key, low_key in pending.pop(key):
+            if log:
+                log(f'{key_str(key)}; check gusher {names[vertex]}{flag(findable)}\n'
+                    f'    adj: {tuple(names[u] for u in bits(high_key[0]))}\n'
+                    f'    non-adj: {tuple(names[u] for u in bits(low_key[0]))}')
+            high = choose(high_key, vertex)
+            low = choose(low_key, vertex)
+            size_h, size_l = 0, 0
+            totlat_h, totlat_l = 0, 0
+            totrisk_h, totrisk_l = 0, 0
+            dist_h, dist_l = 1, 1
+            if high:
+                dist_h = distances[vertex][high[0]]
+                size_h, totlat_h, totrisk_h = high[2:5]
+            if low:
+                dist_l = distances[vertex][low[0]]
+                size_l, totlat_l, totrisk_l = low[2:5]
+            size = size_l + size_h + (1 if findable else 0)
+            total_latency = totlat_l + dist_l*size_l + totlat_h + dist_h*size_h
+            total_risk = totrisk_l + totrisk_h + weights[vertex]*total_latency
+            candidates.append((vertex, findable, size, total_latency, total_risk, high, low))
+            if log:
+                log(f'subgraph: {key_str(key)}\n'
+                    f'    candidate solution: {tree_str(candidates[-1])}\n'
+                    f'    score: {tuning*total_risk + (1-tuning)*total_latency:g}\n')
+        if key != root_key:
+            kept = prune(candidates)
+            if log and len(kept) < len(candidates):
+                log(f'{key_str(key)}; never choose gushers ' +
+                    ', '.join(f'{names[c[0]]}{flag(c[1])}' for c in candidates if c not in kept) + '\n')
+            candidates = kept
+        solved_subgraphs[key] = candidates
+
+    # Solve subgraphs bottom-up, using an explicit stack instead of recursion
+    # A subgraph is only solved once all of the subgraphs it can split into have been solved
+    root_key = subgraph_key(all_gushers, 1 << start)
+    pending = dict()  # subgraphs that have been split but not solved yet
+    stack = [root_key]
+    while stack:
+        key = stack[-1]
+        if key in solved_subgraphs:
+            stack.pop()
+            continue
+        if key not in pending:
+            pending[key] = splits(key)
+        # Subgraphs with fewer than 2 suspected gushers are base cases and don't need to be solved
+        unsolved = [child for _, _, high_key, low_key in pending[key] for child in (high_key, low_key)
+                    if child[0] & (child[0] - 1) and child not in solved_subgraphs]
+        if unsolved:
+            stack.extend(unsolved)
         else:
-            # Generate best subtrees for this subgraph
-            search_set = set(gushers).difference(opened)
-            for vertex in search_set:
-                findable = vertex in suspected
-                neighborhood = set(gushers.adj(vertex))
-                suspect_if_high = suspected.intersection(neighborhood)
-                suspect_if_low = suspected.difference({vertex}).difference(neighborhood)
-                # suspect_if_high, suspect_if_low = split(suspected.difference({vertex}), neighborhood)
-                # Don't open non-suspected gushers that are adjacent to all/none of the suspected gushers
-                # Opening them can neither find the Goldie nor provide additional information about the Goldie
-                if not findable and not (suspect_if_high and suspect_if_low):
-                    continue
-                print_log(f'{key_str}; check gusher {vertex}{flag(findable)}\n'
-                          f'    adj: {tuple(suspect_if_high)}\n'
-                          f'    non-adj: {tuple(suspect_if_low)}')
-                opened_new = opened + tuple(vertex)
-                high = recurse(suspect_if_high, opened_new, solved)
-                low = recurse(suspect_if_low, opened_new, solved)
-                dist_h, dist_l = 1, 1
-                if high:
-                    dist_h = distance(vertex, high.name)
-                if low:
-                    dist_l = distance(vertex, low.name)
-                root = GusherNode(vertex, gusher_map=gushers, findable=findable)
-                root.add_children(high, low, dist_h, dist_l)
-                candidates.append(root)
-                print_log(f'subgraph: {key_str}\n'
-                          f'    candidate solution: {write_tree(root)}\n'
-                          f'    score: {score(root.total_latency, root.total_risk):g}\n')
-            solved[key] = deepcopy(candidates)
-
-        latest_open = opened[-1]
-        root = min(candidates, key=lambda tree: score(*candidate_cost(tree, latest_open)))
-        print_log(f'{key_str}; options: \n' +
-                  '\n'.join(f'    ~{latest_open}--{distance(latest_open, tree.name):0.2f}--> ' +
-                            f'{tree}({tree.high}, {tree.low}), ' +
-                            f'raw score: {score(tree.total_latency, tree.total_risk):0.2f}, ' +
-                            f'final score: {score(*candidate_cost(tree, latest_open)):0.2f}'
-                            for tree in candidates) +
-                  f'\n    choose gusher {root}: {write_tree(root)}')
+            solve(key)
+            stack.pop()
+
+    return choose(root_key, start)
+
+
+def get_strat(gushers, start=BASKET_LABEL, tuning=0.5, all_distances=None, all_weights=None, debug=False):
+    """Build the optimal decision tree for a gusher map. Memoized algorithm."""
+    # Gushers are referred to by their ids in the gusher map
+    names = gushers.names
+    distances = gushers.distance_matrix
+    weights = [gushers.weight(name) for name in names]
+    open_weights = weights
+    if all_distances:
+        distances = [[all_distances]*len(names) for _ in names]
+    if all_weights:
+        open_weights = [all_weights]*len(names)
+    all_gushers = sum(1 << gushers.name_to_id[vertex] for vertex in gushers)
+
+    log = None
+    if debug:
+        log = print
+        log(f"(U | ~O) means gushers in U could have Goldie, gushers in O have already been opened\n"
+            f"O only lists opened gushers that affect which gushers can be opened next\n"
+            f"------------------------------------------------------------------------------------")
+    best = solve_strat(all_gushers, gushers.name_to_id[start], gushers.adj_masks, distances, weights, open_weights,
+                       tuning, log, names)
+
+    def build_tree(candidate):
+        """Build the tree for a candidate. GusherNodes are only created for the candidates in the final tree."""
+        if not candidate:
+            return None
+        vertex, findable, size, total_latency, total_risk, high, low = candidate
+        root = GusherNode(names[vertex], gusher_map=gushers, findable=findable)
+        if high or low:
+            high = build_tree(high)
+            low = build_tree(low)
+            dist_h = distances[vertex][high.id] if high else 1
+            dist_l = distances[vertex][low.id] if low else 1
+            root.add_children(high, low, dist_h, dist_l)
         return root
 
-    print_log(f"(U | ~O) means gushers in U could have Goldie, gushers in O have already been opened\n"
-              f"------------------------------------------------------------------------------------")
-    root = recurse(set(gushers), tuple(start), solved_subgraphs)
+    root = build_tree(best)
     root.update_costs(gushers, start=start)
     return root
 
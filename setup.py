@@ -39,8 +39,7 @@ setup(
                 'networkx',
                 'matplotlib',
                 'numpy',
-                'scipy',
-                'pyparsing'
+                'scipy'
         ],
         entry_points={
                 'console_scripts': [